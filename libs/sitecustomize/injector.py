@@ -1,23 +1,12 @@
 import os
+import stat
 import sys
 from pathlib import Path
 import time
 import importlib.abc
 import importlib.machinery
 import importlib.util
-from uuid import uuid4
-import json
-from copy import deepcopy
-import hashlib
-from functools import cmp_to_key
-
-try:
-    from packaging.version import Version
-except BaseException as e:
-    import warnings
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    warnings.filterwarnings("ignore", category=UserWarning)
-    from distutils.version import LooseVersion as Version
+from functools import lru_cache
 
 # This is handled differently in different versions of Python
 try:
@@ -26,8 +15,7 @@ except:
     from importlib_metadata import PathDistribution
 
 from .logging import log, verbosity_level
-from .package_storage import PackageStorage
-from .pip_requirements_parser import RequirementsFile
+from .package_storage import PackageStorage, json_loads, json_dumps, _get_version_class
 
 
 
@@ -35,6 +23,10 @@ STORAGE_NAME             = 'depy_v1'
 STORAGE_ROOT             = Path(os.environ['DEPY_CACHE_PATH']) if os.environ.get('DEPY_CACHE_PATH') else Path.home() / '.local' / STORAGE_NAME
 STORAGE_PATH_REQS        = STORAGE_ROOT / 'requirements'
 STORAGE_PATH_PACKAGES    = STORAGE_ROOT / 'packages'
+STORAGE_PATH_INDEX       = STORAGE_ROOT / 'sys_path_index'
+STORAGE_INDEX_MAX_FILES  = 512
+STORAGE_INDEX_SLACK_NS   = 2_000_000_000
+LIBRARY_MODIFICATIONS    = Path(os.path.abspath(__file__)).parent.parent.parent / 'etc' / 'library_modifications.json'
 START_TIME               = time.time()
 CONFLICT_RESOLUTION_MODE = os.environ.get('DEPY_MODE', 'strict')
 
@@ -44,14 +36,14 @@ def profile(func):
         if 'data' not in profile.__dict__:
             profile.data = {}
 
-        def wrap(*args, **kwargs):
-            if func.__name__ not in profile.data:
-                profile.data[func.__name__] = {'calls': 0, 'time': 0}
+        # Times are accumulated as integer nanoseconds, and only converted when they are printed
+        entry = profile.data.setdefault(func.__name__, {'calls': 0, 'time': 0})
 
-            start  = time.time()
+        def wrap(*args, **kwargs):
+            start  = time.perf_counter_ns()
             result = func(*args, **kwargs)
-            profile.data[func.__name__]['time']  += time.time() - start
-            profile.data[func.__name__]['calls'] += 1
+            entry['time']  += time.perf_counter_ns() - start
+            entry['calls'] += 1
             return result
 
         return wrap
@@ -59,6 +51,36 @@ def profile(func):
     return func
 
 
+def _copy_requirements(requirements):
+    """
+    Copy a dictionary of library names to spec lists. This is all that's needed for these, and is much cheaper than a deepcopy.
+    """
+    return {lib: list(specs) for lib, specs in requirements.items()}
+
+
+class Requirement():
+    """
+    A single library and spec from a requirements file. There can be a lot of these, so they use slots instead of a dictionary.
+    """
+    __slots__ = ('lib', 'spec', 'extras')
+
+    def __init__(self, lib, spec, extras=None):
+        self.lib    = lib
+        self.spec   = spec
+        self.extras = extras
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Requirement):
+            return NotImplemented
+
+        return self.lib == other.lib and self.spec == other.spec and self.extras == other.extras
+
+
+    def __repr__(self):
+        return f'Requirement({self.lib!r}, {self.spec!r}, {self.extras!r})'
+
+
 def print_profile_data():
     if 'data' not in profile.__dict__:
         return
@@ -68,7 +90,8 @@ def print_profile_data():
 
     for entry in entries_in_order:
         if profile.data[entry]['calls']:
-            print('%-30s %-14s %-12s %-10s' % (entry, profile.data[entry]['calls'], round(profile.data[entry]['time'], 2), round((profile.data[entry]['time'] / profile.data[entry]['calls']), 2)))
+            total_time = profile.data[entry]['time'] / 1e9
+            print('%-30s %-14s %-12s %-10s' % (entry, profile.data[entry]['calls'], round(total_time, 2), round((total_time / profile.data[entry]['calls']), 2)))
 
 
 
@@ -105,45 +128,59 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
     module is that we want to use.
     """
 
-    library_mods = {}
+    library_mods      = {}
+    _index_file_count = None    # Number of system path index files, once they've been counted in this process
 
 
     def __init__(self, requirements):
+        from uuid import uuid4
+
         self.sys_path_marker   = '/' + uuid4().hex
         sys.path.insert(0, self.sys_path_marker)
         self.ignored_sys_path  = self._setup_ignored_sys_paths()
 
         # Uniquify sys path
-        sys.path = sorted(set(sys.path), key=sys.path.index)
+        sys.path = list(dict.fromkeys(sys.path))
 
         if isinstance(requirements, Path):
             requirements = str(requirements)
 
         log('Injector loaded:', requirements, min_level=1)
-        self.requirements      = requirements
-        self.storage           = PackageStorage()
-        self.complete_reqs     = {}     # The complete set of requirements and their locations, updated as needed over time
-        self.reqs_by_path      = {}     # Already processed system paths
-        self.lib_metadata      = {}     # Used to find distribution data
-        self.loadable_files    = {}     # Loadable files keyed by path
-        self.bad_paths         = set()  # System paths that could not be analyzed
-        self.resolved_reqs     = self._load_requirements()
+        self.requirements             = requirements
+        self.storage                  = PackageStorage()
+        self._parse_spec              = lru_cache(maxsize=None)(self.storage.parse_requirement_spec)
+        self.complete_reqs            = {}           # The complete set of requirements and their locations, updated as needed over time
+        self.reqs_by_path             = {}           # Already processed system paths
+        self.lib_metadata             = {}           # Used to find distribution data
+        self.loadable_files           = {}           # Loadable files keyed by path
+        self.bad_paths                = frozenset()  # System paths that could not be analyzed
+        self._process_cache           = {}           # Processed system path structures keyed by location and then module
+        self._pre_marker_paths        = []           # System paths before our marker, which take precedence over the requirements
+        self._post_marker_paths       = []           # System paths after our marker
+        self._sys_path_snapshot       = None         # Copy of the sys.path that the marker partitions were created from
+        self._path_ranks              = {}           # Precedence of each system path when merging into the complete requirements
+        self._resolved_rank           = 0            # Precedence of the resolved requirements when merging into the complete requirements
+        self._complete_ranks          = {}           # Precedence of the source of each entry in the complete requirements
+        self._complete_reqs_stale     = True         # Whether the complete requirements need to be re-created from scratch
+        self._sorted_complete_keys    = None         # Sorted module names from the complete requirements, for prefix searches
+        self.resolved_reqs            = self._load_requirements()
 
         if 'DEPY_FORCEDLIBS' in os.environ:
             forced_paths = os.environ['DEPY_FORCEDLIBS'].split(':')
             sys.path     = forced_paths + sys.path
 
-        self._add_requirements_to_sys_path(self.resolved_reqs, self.ignored_sys_path)
+        self.ignored_sys_path = self._add_requirements_to_sys_path(self.resolved_reqs, self.ignored_sys_path)
 
 
     @profile
     def _add_requirements_to_sys_path(self, resolved_reqs, ignored_paths):
         """
         Add all resolved requirements to the end of the system path so that they can be found in case any process is specificially
-        referencing sys.path. This also adds them to the ignored paths so that we don't deal with them in a second way.
+        referencing sys.path. This also adds them to the ignored paths so that we don't deal with them in a second way, returning the
+        updated set of ignored paths.
         """
         requirement_roots = set()
-        path_additions    = set()
+        path_additions    = {}      # Used as an ordered set
 
         for req, path in sorted(resolved_reqs.items(), key=lambda x: x[1]):
             directory = os.path.dirname(path)
@@ -152,22 +189,32 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             if path.endswith('__init__.py') and not req.endswith('__init__'):
                 paths += 1
 
-            for _ in range(paths):
-                directory = os.path.dirname(directory)
+            # Strip off one directory for each level of the module in a single split
+            if paths:
+                directory = directory.rsplit(os.sep, paths)[0]
+
+            # Many modules share the same root, so only look for its binary directory the first time that it's seen
+            if directory in requirement_roots:
+                continue
 
             requirement_roots.add(directory)
             binary_dir = os.path.join(directory, 'bin')
 
-            if binary_dir not in path_additions and os.path.isdir(binary_dir):
+            if os.path.isdir(binary_dir):
                 log('Found binary directory', binary_dir, min_level=2)
-                os.environ['PATH'] += ':' + binary_dir
-                path_additions.add(binary_dir)
+                path_additions[binary_dir] = None
 
-        if os.environ.get('DEPY_ADD_PP', '1') == '1':
-            os.environ['PYTHONPATH'] += ':'.join(requirement_roots)
+        # Set each environmental variable once, rather than on every addition
+        if path_additions:
+            existing           = [os.environ['PATH']] if os.environ.get('PATH') else []
+            os.environ['PATH'] = os.pathsep.join(existing + list(path_additions))
+
+        if os.environ.get('DEPY_ADD_PP', '1') == '1' and requirement_roots:
+            existing                 = [os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else []
+            os.environ['PYTHONPATH'] = os.pathsep.join(existing + list(requirement_roots))
 
         sys.path.extend(requirement_roots)
-        ignored_paths.update(requirement_roots)
+        return ignored_paths.union(requirement_roots)
 
 
     def __del__(self):
@@ -180,12 +227,18 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         Pre-filter system paths to make sure that we only look through valid directories
         """
         ignored = set()
+        checked = {}
 
+        # A stat() per entry is cheaper than listing every parent directory, and only needs execute permission on the parents;
+        # duplicated entries are only checked once
         for location in sys.path:
-            if location == self.sys_path_marker or not os.path.isdir(location):
+            if location not in checked:
+                checked[location] = location != self.sys_path_marker and os.path.isdir(location)
+
+            if not checked[location]:
                 ignored.add(location)
 
-        return ignored
+        return frozenset(ignored)
 
 
     @profile
@@ -251,7 +304,25 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
 
         log('Finding spec for', fullname, path, target, min_level=3)
 
-        # Since we load system paths on the fly, we always need to look there to see if a system path contains what we want
+        # Modules that have already been resolved to a loadable file can be used directly, as long as the system paths haven't
+        # changed since (Python adds the script directory after we've been loaded, for example). The complete requirements are
+        # merged by the precedence of each system path, so they hold the same file that walking the system paths would find. That
+        # is only true for the top level of the system paths though, so submodules are only used directly when they come from the
+        # same source as their parent, otherwise they could be from a different copy of the package.
+        self._refresh_path_partitions()
+        resolved_req = None if self._complete_reqs_stale else self.complete_reqs.get(fullname)
+
+        if resolved_req and '.' in fullname:
+            rank = self._complete_ranks.get(fullname)
+
+            if rank is None or rank != self._complete_ranks.get(fullname.rpartition('.')[0]):
+                resolved_req = None
+
+        if resolved_req and self._is_loadable(resolved_req):
+            log('Loading spec for', fullname, path, target, resolved_req, min_level=3)
+            return importlib.util.spec_from_file_location(fullname, resolved_req)
+
+        # Since we load system paths on the fly, we need to look there to see if a system path contains what we want
         self._find_sys_path_file(fullname)
 
         if fullname not in self.complete_reqs and '.' in fullname:
@@ -282,16 +353,10 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         """
         if existing_path not in self.loadable_files:
             self.loadable_files[existing_path] = {}
-            structure = self.storage.get_module_structure(existing_path, depth_max=1)
-
-            for entry in structure:
-                complete_path = os.path.join(existing_path, structure[entry] or entry)
-
-                if not self._is_loadable(complete_path):
-                    if os.path.isfile(os.path.join(complete_path, '__init__.py')):
-                        complete_path = os.path.join(complete_path, '__init__.py')
+            structure = self._get_directory_structure(existing_path)
 
-                if self._is_loadable(complete_path):
+            for entry, complete_path in structure.items():
+                if complete_path.endswith(('.py', '.so')):
                     self.loadable_files[existing_path][entry] = complete_path
 
         return self.loadable_files[existing_path].get(module)
@@ -303,18 +368,17 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         A set of modifications that may necessary because some packages are not restrictive enough in their requirements.
         """
         if not self.library_mods:
-            with open(Path(os.path.abspath(__file__)).parent.parent.parent / 'etc' / 'library_modifications.json', 'r') as fh:
-                self.library_mods = json.load(fh)
+            with open(LIBRARY_MODIFICATIONS, 'rb') as fh:
+                self.library_mods = json_loads(fh.read())
 
         return self.library_mods
 
 
-    @profile
     def _is_loadable(self, path):
         """
         Determine if a provided path is loadable by Python.
         """
-        return bool(path and path.endswith('.py') or path.endswith('.so'))
+        return bool(path) and path.endswith(('.py', '.so'))
 
 
     @profile
@@ -372,6 +436,7 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
                 self.complete_reqs[root_name] = existing_path
 
             self.complete_reqs[fullname] = resolved_file
+            self._sorted_complete_keys   = None
 
         return resolved_file
 
@@ -381,20 +446,18 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         """
         See if a specified module exists in system paths. This may have to probe deeper into those directories if we haven't done it, yet.
         """
-        sys_path_updated = False
-        resolved         = None
+        resolved = None
+        self._refresh_path_partitions()
 
         # Look in all system paths that are in the list before we "injected" the specified requirements.
-        for sys_path in sys.path:
-            if sys_path == self.sys_path_marker:
-                break
-
+        for sys_path in self._pre_marker_paths:
             if sys_path not in self.ignored_sys_path:
-                resolved, updated = self._find_file_in_sys_path(sys_path, fullname)
-                sys_path_updated |= updated
+                resolved, _ = self._find_file_in_sys_path(sys_path, fullname)
 
                 if resolved:
-                    self.complete_reqs[fullname] = resolved
+                    self.complete_reqs[fullname]   = resolved
+                    self._complete_ranks[fullname] = self._path_ranks[sys_path]
+                    self._sorted_complete_keys     = None
                     break
 
         # If we didn't find it in the newer system paths, look and see if we have them in the resolved requirements
@@ -403,50 +466,101 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
 
         # Finally, if we haven't found a loadable file, look in the old set of system paths
         if not resolved:
-            processing = False
-
-            for sys_path in sys.path:
-                if processing:
-                    if sys_path not in self.ignored_sys_path:
-                        resolved_file, updated = self._find_file_in_sys_path(sys_path, fullname)
-                        sys_path_updated      |= updated
+            for sys_path in self._post_marker_paths:
+                if sys_path not in self.ignored_sys_path:
+                    resolved_file, _ = self._find_file_in_sys_path(sys_path, fullname)
 
-                        if resolved_file:
-                            self.complete_reqs[fullname] = resolved_file
-                            break
-                elif sys_path == self.sys_path_marker:
-                    processing = True
+                    if resolved_file:
+                        self.complete_reqs[fullname]   = resolved_file
+                        self._complete_ranks[fullname] = self._path_ranks[sys_path]
+                        self._sorted_complete_keys     = None
+                        break
 
-        # The individual system path dictionaries may have been updated based on our searching,
-        # re-create the complete requirements dictionary to include the updated versions
-        if sys_path_updated:
+        # Newly processed system paths are merged into the complete requirements as they're found, so it only has to be re-created
+        # when the order of the system paths has changed
+        if self._complete_reqs_stale:
             self._update_complete_requirements()
 
 
-    @profile
+    def _refresh_path_partitions(self):
+        """
+        Split the system paths into the ones before and after our marker. This is only redone when sys.path differs from the copy that
+        the partitions were created from, which catches entries being replaced in place, instead of searching for the marker every time
+        that the paths are walked.
+        """
+        if sys.path == self._sys_path_snapshot:
+            return
+
+        self._sys_path_snapshot   = list(sys.path)
+        self._complete_reqs_stale = True
+
+        try:
+            marker_index = sys.path.index(self.sys_path_marker)
+        except ValueError:
+            self._pre_marker_paths  = list(sys.path)
+            self._post_marker_paths = []
+        else:
+            self._pre_marker_paths  = sys.path[:marker_index]
+            self._post_marker_paths = sys.path[marker_index + 1:]
+
+        # Higher ranks take precedence: the system paths before our marker, then the resolved requirements, and then the system paths
+        # after our marker. Within each of those, earlier system paths take precedence over later ones, the same as they do for Python.
+        self._resolved_rank = len(self._post_marker_paths)
+        self._path_ranks    = {}
+
+        for rank, sys_path in enumerate(reversed(self._post_marker_paths)):
+            self._path_ranks[sys_path] = rank
+
+        for rank, sys_path in enumerate(reversed(self._pre_marker_paths), start=self._resolved_rank + 1):
+            self._path_ranks[sys_path] = rank
+
+
     def _find_appropriate_dir(self, fullname):
         """
         Look to see if any indexed module location has the provided module name as a prefix. If so, we can create a valid namespace.
         """
+        import bisect
+
         prefix = fullname + '.'
 
-        # If we have lower-level modules with this prefix, then we can just create a namespace
-        for module_name in self.complete_reqs:
-            if module_name.startswith(prefix):
-                self.complete_reqs[fullname] = None
-                break
+        # The sorted module names are cleared whenever modules are added to the complete requirements, so they're only re-sorted then
+        if self._sorted_complete_keys is None:
+            self._sorted_complete_keys = sorted(self.complete_reqs)
 
+        # If we have lower-level modules with this prefix, then we can just create a namespace. Any of them would sort directly after
+        # the prefix itself.
+        index = bisect.bisect_left(self._sorted_complete_keys, prefix)
 
-    @profile
-    def _update_requirements(self, dest_reqs, input_requirements):
+        if index < len(self._sorted_complete_keys) and self._sorted_complete_keys[index].startswith(prefix):
+            self.complete_reqs[fullname] = None
+            bisect.insort(self._sorted_complete_keys, fullname)
+
+
+    def _update_requirements(self, input_requirements, rank):
         """
         If we use just the update function to update one dictionary with another, we will miss out on the fact that a file
-        (ie. __init__.py) should take precedence over just a path with no loadable file. This updates the destination requirements
-        properly.
+        (ie. __init__.py) should take precedence over just a path with no loadable file. This updates the complete requirements
+        properly, using the rank of the source to decide between entries so that sources can be merged in any order. A loadable file
+        always wins over a path without one, and otherwise the entry from the highest ranked source is kept.
         """
-        for key in input_requirements:
-            if key not in dest_reqs or self._is_loadable(input_requirements[key]):
-                dest_reqs[key] = input_requirements[key]
+        for key, path in input_requirements.items():
+            if key in self.complete_reqs:
+                current_rank = self._complete_ranks.get(key)
+
+                if current_rank is not None and current_rank != rank:
+                    current_loadable = self._is_loadable(self.complete_reqs[key])
+
+                    if self._is_loadable(path) == current_loadable:
+                        if current_rank > rank:
+                            continue
+                    elif current_loadable:
+                        continue
+
+            self.complete_reqs[key]   = path
+            self._complete_ranks[key] = rank
+
+        if input_requirements:
+            self._sorted_complete_keys = None
 
 
     @profile
@@ -456,31 +570,26 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         and a path. It uses the input requirements as well as the sys.path list in order
         to create this.
         """
-        # return
-        self.complete_reqs = {}
+        self._refresh_path_partitions()
+        self.complete_reqs         = {}
+        self._complete_ranks       = {}
+        self._sorted_complete_keys = None
+        self._complete_reqs_stale  = False
 
         # First add all files from the system paths that are after our own path marker
-        processing = False
-
-        for sys_path in sys.path:
-            if processing:
-                if sys_path not in self.ignored_sys_path:
-                    sys_path_reqs, _ = self._process_sys_path(sys_path)
-                    self._update_requirements(self.complete_reqs, sys_path_reqs)
-            elif sys_path == self.sys_path_marker:
-                processing = True
+        for sys_path in self._post_marker_paths:
+            if sys_path not in self.ignored_sys_path:
+                sys_path_reqs, _ = self._process_sys_path(sys_path)
+                self._update_requirements(sys_path_reqs, self._path_ranks[sys_path])
 
         # Next, add specified requirements
-        self._update_requirements(self.complete_reqs, self.resolved_reqs)
+        self._update_requirements(self.resolved_reqs, self._resolved_rank)
 
         # Finally, overlay all system paths that are sooner in the list than our own marker
-        for sys_path in sys.path:
-            if sys_path == self.sys_path_marker:
-                break
-
+        for sys_path in self._pre_marker_paths:
             if sys_path not in self.ignored_sys_path:
                 sys_path_reqs, _ = self._process_sys_path(sys_path)
-                self._update_requirements(self.complete_reqs, sys_path_reqs)
+                self._update_requirements(sys_path_reqs, self._path_ranks[sys_path])
 
 
     @profile
@@ -491,6 +600,11 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         that means that we're getting the structure farther into the given path, so determine
         and update that path with the additional structure.
         """
+        location_cache = self._process_cache.get(location)
+
+        if location_cache and module in location_cache:
+            return location_cache[module], False
+
         if module:
             process_location = os.path.join(location, *(module.split('.')))
         else:
@@ -502,7 +616,16 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             self._process_new_sys_path(process_location, location, module)
             sys_path_updated = True
 
-        return self.reqs_by_path.get(location, {}), sys_path_updated
+        sys_path_reqs = self.reqs_by_path.get(location)
+
+        # The structure for a location is only ever updated in place, so once both exist it is safe to hand back the same dictionary
+        if sys_path_reqs is None:
+            return {}, sys_path_updated
+
+        if process_location in self.reqs_by_path:
+            self._process_cache.setdefault(location, {})[module] = sys_path_reqs
+
+        return sys_path_reqs, sys_path_updated
 
 
     @profile
@@ -514,34 +637,216 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         real_process_location = os.path.realpath(process_location)
 
         try:
-            structure     = self.storage.get_module_structure(real_process_location, depth_max=1)
+            structure     = self._get_directory_structure(real_process_location, use_index=not module)
             new_structure = {}
             entry_prefix  = module if module else ''
 
-            for entry in structure:
-                complete_path = os.path.join(real_process_location, structure[entry] or entry)
-
-                if not self._is_loadable(complete_path):
-                    if os.path.isfile(os.path.join(complete_path, '__init__.py')):
-                        complete_path = os.path.join(complete_path, '__init__.py')
-
-                prefix                        = entry_prefix + '.' if entry_prefix and entry else entry_prefix
-                new_structure[prefix + entry] = complete_path
-                structure[entry]              = complete_path
+            for entry, complete_path in structure.items():
+                prefix                                    = entry_prefix + '.' if entry_prefix and entry else entry_prefix
+                new_structure[sys.intern(prefix + entry)] = complete_path
 
             if location not in self.reqs_by_path:
                 self.reqs_by_path[location] = {}
+                self._process_cache.pop(location, None)
 
             if process_location not in self.reqs_by_path:
                 self.reqs_by_path[process_location] = {}
 
             self.reqs_by_path[location].update(new_structure)
 
+            # Merge the new entries directly into the complete requirements, instead of having to re-create them from every system path
+            if location in self._path_ranks:
+                self._update_requirements(new_structure, self._path_ranks[location])
+
             if process_location != location:
                 self.reqs_by_path[process_location].update(structure)
         except:
             log('Bad system path', location, min_level=2)
-            self.bad_paths.add(location)
+            self.bad_paths = self.bad_paths.union((location,))
+
+
+    @profile
+    def _get_directory_structure(self, location, use_index=False):
+        """
+        Get the modules directly within a directory, mapped to their complete paths. If requested, the result is stored in an index
+        so that later runs only have to check that the directory and its subdirectories have not been modified instead of listing it
+        again. This is only worth it for the system paths themselves, which can be large, so the index stays small.
+        """
+        location = str(location)
+
+        if not use_index:
+            return self._scan_directory(location)[0]
+
+        import hashlib
+
+        index_file   = STORAGE_PATH_INDEX / hashlib.sha256(location.encode('utf-8')).hexdigest()
+        index_exists = False
+
+        try:
+            with open(index_file, 'rb') as fh:
+                index_exists = True
+                index        = json_loads(fh.read())
+
+            mtimes = index['mtimes']
+
+            if index['location'] == location and self._index_is_trusted(index['scan_time'], mtimes):
+                if all(os.stat(path).st_mtime_ns == mtime for path, mtime in mtimes.items()):
+                    return index['structure']
+        except:
+            pass
+
+        scan_time         = time.time_ns()
+        structure, mtimes = self._scan_directory(location)
+
+        if mtimes and self._index_is_trusted(scan_time, mtimes):
+            from uuid import uuid4
+
+            try:
+                os.makedirs(STORAGE_PATH_INDEX, mode=0o777, exist_ok=True)
+                tmp_name = str(index_file) + '.' + uuid4().hex
+
+                with open(tmp_name, 'wb') as fh:
+                    fh.write(json_dumps({'location': location, 'scan_time': scan_time, 'mtimes': mtimes, 'structure': structure}))
+
+                os.replace(tmp_name, index_file)
+            except BaseException as e:
+                log('Exception while writing the system path index', location, e, min_level=2)
+
+                try:
+                    os.unlink(tmp_name)
+                except:
+                    pass
+            else:
+                if not index_exists:
+                    self._index_added()
+
+        return structure
+
+
+    def _index_is_trusted(self, scan_time, mtimes):
+        """
+        A directory that is modified in the same timestamp tick as it was scanned keeps its modification time, so an index can only be
+        trusted when the modification times are clearly older than the scan.
+        """
+        return all(mtime < scan_time - STORAGE_INDEX_SLACK_NS for mtime in mtimes.values())
+
+
+    def _index_added(self):
+        """
+        Keep track of the number of index files after a new one has been created, so that the index directory only has to be listed the
+        first time in each process and whenever the count goes over the limit.
+        """
+        if self._index_file_count is None:
+            self._index_file_count = self._prune_sys_path_index()
+        else:
+            self._index_file_count += 1
+
+            if self._index_file_count > STORAGE_INDEX_MAX_FILES:
+                self._index_file_count = self._prune_sys_path_index()
+
+
+    def _prune_sys_path_index(self):
+        """
+        Keep the number of index files bounded, since locations that are no longer used are never looked up again. The files that were
+        written longest ago are removed first, and are simply re-created if their locations are still used. Returns the number of index
+        files that are left.
+        """
+        try:
+            with os.scandir(STORAGE_PATH_INDEX) as entries:
+                index_files = [(entry.stat().st_mtime_ns, entry.path) for entry in entries]
+
+            if len(index_files) > STORAGE_INDEX_MAX_FILES:
+                for _, path in sorted(index_files)[:len(index_files) - STORAGE_INDEX_MAX_FILES]:
+                    os.unlink(path)
+
+            return min(len(index_files), STORAGE_INDEX_MAX_FILES)
+        except BaseException as e:
+            log('Exception while pruning the system path index', e, min_level=2)
+            return 0
+
+
+    def _scan_directory(self, location):
+        """
+        List a directory once, relying on the entry types that it returns, so the only additional checks are for the __init__.py files
+        of any subdirectories. Returns the structure along with the modification times that it depends on.
+        """
+        structure   = {}
+        directories = []
+
+        try:
+            mtimes = {location: os.stat(location).st_mtime_ns}
+
+            with os.scandir(location) as entries:
+                for entry in entries:
+                    name = entry.name
+
+                    if entry.is_dir():
+                        if name != '__pycache__' and not name.endswith('.dist-info'):
+                            directories.append(entry)
+                    elif name.endswith('.py'):
+                        if name == '__init__.py':
+                            structure[''] = entry.path
+
+                        structure[name[:-3]] = entry.path
+                    elif name.endswith('.so'):
+                        structure[name.split('.')[0]] = entry.path
+        except OSError:
+            return {}, {}
+
+        directories = [entry for entry in directories if entry.name not in structure]
+        packages    = self._find_packages(location, [entry.name for entry in directories])
+
+        # Files take precedence over directories with the same name, and directories are loaded through their __init__.py if they have
+        # one. Any of them may gain or lose their __init__.py later, which changes their modification time, so they are all tracked.
+        for entry in directories:
+            if entry.name in packages:
+                structure[entry.name] = f'{entry.path}{os.sep}__init__.py'
+            else:
+                structure[entry.name] = entry.path
+
+            try:
+                mtimes[entry.path] = entry.stat().st_mtime_ns
+            except OSError:
+                pass
+
+        return structure, mtimes
+
+
+    def _find_packages(self, location, names):
+        """
+        Determine which of the named subdirectories of a location contain an __init__.py file. When possible, the checks are all made
+        relative to a single open handle on the location so that the kernel doesn't have to resolve the full path for every one.
+        """
+        packages = set()
+
+        if not names:
+            return packages
+
+        if os.stat in os.supports_dir_fd:
+            try:
+                dir_fd = os.open(location, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            except OSError:
+                dir_fd = None
+        else:
+            dir_fd = None
+
+        try:
+            for name in names:
+                try:
+                    if dir_fd is None:
+                        stats = os.stat(f'{location}{os.sep}{name}{os.sep}__init__.py')
+                    else:
+                        stats = os.stat(f'{name}{os.sep}__init__.py', dir_fd=dir_fd)
+                except OSError:
+                    continue
+
+                if stat.S_ISREG(stats.st_mode):
+                    packages.add(name)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+        return packages
 
 
     @profile
@@ -571,23 +876,22 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         return self._install_requirements(requirements, processed_files)
 
 
-    @profile
     def _combine_requirements(self, input_requirements, existing_requirements):
         for req in input_requirements:
-            if req['lib'] not in existing_requirements:
-                existing_requirements[req['lib']] = []
+            if req.lib not in existing_requirements:
+                existing_requirements[req.lib] = []
 
-            if req['spec'] not in existing_requirements[req['lib']]:
-                existing_requirements[req['lib']].append(req['spec'])
+            if req.spec not in existing_requirements[req.lib]:
+                existing_requirements[req.lib].append(req.spec)
 
-            # if req['lib'] not in existing_requirements:
-            #     existing_requirements[req['lib']] = {'specs': [], 'extras': set()}
+            # if req.lib not in existing_requirements:
+            #     existing_requirements[req.lib] = {'specs': [], 'extras': set()}
 
-            # if req['spec'] not in existing_requirements[req['lib']]:
-            #     existing_requirements[req['lib']]['specs'].append(req['spec'])
+            # if req.spec not in existing_requirements[req.lib]:
+            #     existing_requirements[req.lib]['specs'].append(req.spec)
 
-            # if req['extras']:
-            #     existing_requirements[req['lib']]['extras'] = existing_requirements[req['lib']]['extras'].union(req['extras'])
+            # if req.extras:
+            #     existing_requirements[req.lib]['extras'] = existing_requirements[req.lib]['extras'].union(req.extras)
 
         return existing_requirements
 
@@ -620,62 +924,74 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             return None
 
         try:
-            with open(location / 'resolution', 'r') as fh:
-                return json.load(fh)
+            with open(location / 'resolution', 'rb') as fh:
+                return json_loads(fh.read())
         except:
             pass
 
         return None
 
 
-    def sort_versions(self, spec1, spec2):
-        parsed1 = self.storage.parse_requirement_spec(spec1)
-        parsed2 = self.storage.parse_requirement_spec(spec2)
-
-        if parsed1['op'] == 'any':
-            return 1
-
-        if parsed2['op'] == 'any':
-            return -1
-
-        v1 = Version(parsed1['ver'])
-        v2 = Version(parsed2['ver'])
-
-        if v1 > v2:
-            return 1
+    def _version_sort_key(self, spec):
+        """
+        Sort key that orders specs by their version. Specs that allow any version are considered larger than all others.
+        """
+        Version = _get_version_class()
+        parsed  = self._parse_spec(spec)
 
-        if v2 > v1:
-            return -1
+        if parsed['op'] == 'any':
+            return (True, Version('0'))
 
-        return 0
+        return (False, Version(parsed['ver']))
 
 
     @profile
-    def _install_requirements(self, requirements, processed_files):
+    def _install_requirements(self, requirements, processed_files, resolved_requirements=None):
         """
         Determine if the combined set of requirements has already been resolved and cached. If it has, use that existing cache instead of
-        continuously resolving versions and dependencies.
+        continuously resolving versions and dependencies. Requirements that have already been resolved can also be provided directly.
         """
-        sha = hashlib.sha256()
-        sha.update(str(requirements).encode('utf-8'))
-        sha.update(CONFLICT_RESOLUTION_MODE.encode('utf-8'))
-        requirements_hash     = sha.hexdigest()
-        resolved_requirements = None
+        requirements_hash = None
+
+        if not resolved_requirements:
+            import hashlib
 
-        if self.storage.is_cached(STORAGE_PATH_REQS / requirements_hash):
-            resolved_requirements = self._read_resolved_requirements(STORAGE_PATH_REQS / requirements_hash)
+            sha = hashlib.sha256()
 
-            if resolved_requirements:
-                log('Using cached requirements:', STORAGE_PATH_REQS / requirements_hash, min_level=1)
-                requirements = resolved_requirements
+            # The order of the requirements is kept, since it matters when resolving conflicts, but the extras are sorted since they
+            # are sets and would otherwise be hashed in a different order in every process
+            for req in requirements:
+                sha.update(req.lib.encode('utf-8'))
+                sha.update(b'\0')
+                sha.update(req.spec.encode('utf-8'))
+                sha.update(b'\0')
+                sha.update(','.join(sorted(req.extras or ())).encode('utf-8'))
+                sha.update(b'\n')
+
+            sha.update(CONFLICT_RESOLUTION_MODE.encode('utf-8'))
+            requirements_hash = sha.hexdigest()
+
+            if self.storage.is_cached(STORAGE_PATH_REQS / requirements_hash):
+                resolved_requirements = self._read_resolved_requirements(STORAGE_PATH_REQS / requirements_hash)
+
+                if resolved_requirements:
+                    log('Using cached requirements:', STORAGE_PATH_REQS / requirements_hash, min_level=1)
+
+        if resolved_requirements:
+            requirements = [Requirement(req['lib'], req['spec']) for req in resolved_requirements]
 
         locations      = {}
-        errors         = []
+        errors         = {}     # Used as an ordered set
         combined_reqs  = self._combine_requirements(requirements, {})
-        current_reqs   = deepcopy(combined_reqs)
+        current_reqs   = _copy_requirements(combined_reqs)
         processing     = True
         processed_reqs = {}
-        req_history    = [deepcopy(current_reqs)]
+        req_history    = [_copy_requirements(current_reqs)]
+        reqs_by_lib    = {}
+
+        # Index the first requirement seen for each library, which is where any extras are taken from
+        for req in requirements:
+            reqs_by_lib.setdefault(req.lib, req)
 
         while processing:
             processing = False
@@ -685,7 +1001,7 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
                 location          = None
 
                 if CONFLICT_RESOLUTION_MODE == 'newest':
-                    used_requirements = sorted(used_requirements, key=cmp_to_key(self.sort_versions), reverse=True)
+                    used_requirements = sorted(used_requirements, key=self._version_sort_key, reverse=True)
 
                 while used_requirements:
                     spec     = ','.join(used_requirements)
@@ -699,28 +1015,19 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
                 if location:
                     locations[req] = location
                 else:
-                    error_message = f'ERROR: Unable to cache {req} : {spec}'
-
-                    if error_message not in errors:
-                        errors.append(error_message)
+                    errors[f'ERROR: Unable to cache {req} : {spec}'] = None
 
             # We can short-cut this a bit if we're restoring from cached libraries
             if not resolved_requirements:
                 for lib, location in locations.items():
-                    extras = []
-
-                    for req in requirements:
-                        if req['lib'] == lib:
-                            extras = req.get('extras')
-                            break
-
+                    extras        = reqs_by_lib[lib].extras if lib in reqs_by_lib else []
                     new_reqs      = self._resolve_dependencies(location, processed_files, extras)
                     combined_reqs = self._combine_requirements(new_reqs, combined_reqs)
 
                 if combined_reqs != current_reqs:
                     processing   = True
-                    current_reqs = deepcopy(combined_reqs)
-                    req_history.append(deepcopy(current_reqs))
+                    current_reqs = _copy_requirements(combined_reqs)
+                    req_history.append(_copy_requirements(current_reqs))
 
         if errors:
             print('\n'.join(errors), file=sys.stderr)
@@ -747,13 +1054,15 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             package_file = os.path.join(locations[module], '.structure')
 
             try:
-                with open(package_file, 'r') as fh:
-                    structure = json.load(fh)
+                with open(package_file, 'rb') as fh:
+                    structure = json_loads(fh.read())
 
-                for entry in structure:
-                    structure[entry] = os.path.join(locations[module], structure[entry])
+                # The stored paths are all relative to the package location, so they can be joined directly. Module names are interned
+                # since they are compared against the names being imported over and over.
+                location_prefix = f'{locations[module]}{os.sep}'
 
-                modules_by_location.update(structure)
+                for entry, relative_path in structure.items():
+                    modules_by_location[sys.intern(entry)] = location_prefix + relative_path
             except:
                 log('Unable to get the package for %s at %s', new_dep['lib'] + new_dep['spec'], package_file, min_level=1)
                 continue
@@ -764,8 +1073,9 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             refresh = self._post_process_requirements(resolved_dependencies)
             self.storage.cache_requirements(STORAGE_PATH_REQS / requirements_hash, resolved_dependencies)
 
+            # The modified requirements are installed directly, since reading them back from the cache can be bypassed
             if refresh:
-                return self._load_requirements()
+                return self._install_requirements([], set(), resolved_dependencies)
 
         return modules_by_location
 
@@ -779,37 +1089,54 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         dict_reqs = {}
         updated   = False
 
+        # The modifications are keyed on the lowercase library names, and the same library can be required with different cases
         for req in requirements:
-            dict_reqs[req['lib']] = req
+            dict_reqs.setdefault(req['lib'].lower(), []).append(req)
 
         for library_name in (self.library_modifications.keys() & dict_reqs.keys()):
-            mod = self.library_modifications[library_name]
+            mod        = self.library_modifications[library_name]
+            comparison = mod['comparison']
 
-            if (mod['comparison']['name'] in dict_reqs and
-                    self.storage.compare_versions(Version(dict_reqs[library_name]['version']), mod['op'], Version(mod['version'])) and
-                    self.storage.compare_versions(Version(dict_reqs[mod['comparison']['name']]['version']), mod['comparison']['op'], Version(mod['comparison']['version']))):
-                dict_reqs[mod['comparison']['name']]['version'] = mod['comparison']['new_version']
-                dict_reqs[mod['comparison']['name']]['spec']    = '==' + mod['comparison']['new_version']
-                updated = True
+            if (comparison['name'] in dict_reqs and
+                    any(self.storage.compare_versions(req['version'], mod['op'], mod['version']) for req in dict_reqs[library_name])):
+                for req in dict_reqs[comparison['name']]:
+                    if self.storage.compare_versions(req['version'], comparison['op'], comparison['version']):
+                        req['version'] = comparison['new_version']
+                        req['spec']    = '==' + comparison['new_version']
+                        updated        = True
 
         return updated
 
 
     @profile
     def _process_requirements_file(self, file, processed_files, extras=[]):
+        """
+        Get the requirements from a requirements or poetry lock file. Each file is only parsed once, files are tracked by both the
+        path that was given and the real path so that the same file reached through a symlink isn't parsed again, and a file is
+        marked as processed before it's parsed so that a file that can't be parsed isn't retried.
+        """
         if file in processed_files:
             return []
 
+        real_file = os.path.realpath(file)
+
+        if real_file in processed_files:
+            processed_files.add(file)
+            return []
+
+        processed_files.add(file)
+        processed_files.add(real_file)
+
         try:
             if os.path.basename(file) == 'poetry.lock':
                 from .poetry import PoetryFile
                 rf = PoetryFile.from_lock_file(file)
             else:
+                from .pip_requirements_parser import RequirementsFile
                 rf = RequirementsFile.from_file(file, include_nested=True)
         except:
             return []
 
-        processed_files.add(file)
         requirements = []
 
         for req in rf.requirements:
@@ -823,13 +1150,13 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
             # This module is done here instead of in the modifications because I can't even get versions lower than this to install. Maybe
             # the library modifications should happen earlier, or even here as well?
             if req.name.lower() == 'cryptography':
-                requirements.append({'lib': req.name, 'spec': '==41.0.2'})
+                requirements.append(Requirement(req.name, '==41.0.2'))
             elif req.match_marker(extras):
                 if req.specifier:
                     for spec in req.specifier:
-                        requirements.append({'lib': req.name, 'spec': str(spec), 'extras': req.extras})
+                        requirements.append(Requirement(req.name, str(spec), req.extras))
                 else:
-                    requirements.append({'lib': req.name, 'spec': 'any', 'extras': req.extras})
+                    requirements.append(Requirement(req.name, 'any', req.extras))
 
         return requirements
 
@@ -841,10 +1168,17 @@ class DepyInjectorFinder(importlib.abc.MetaPathFinder):
         """
         manifest = os.path.join(location, '.dependencies')
 
+        # This is called for every location on each pass of the resolution, so skip the file check once it's been handled
+        if manifest in processed_files:
+            return {}
+
         if os.path.isfile(manifest):
             requirements = self._process_requirements_file(manifest, processed_files, extras)
 
             if requirements:
                 return requirements
+        else:
+            # The cached locations aren't modified, so a missing manifest won't show up later
+            processed_files.add(manifest)
 
         return {}
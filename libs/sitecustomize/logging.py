@@ -1,8 +1,10 @@
 import os
 import sys
+from functools import lru_cache
 
 
 
+@lru_cache(maxsize=1)
 def verbosity_level():
     value = os.environ.get('DEPY_DEBUG')
 
@@ -17,6 +19,12 @@ def verbosity_level():
     return value
 
 
+# The verbosity can't change while running, so it's only determined once
+_VERBOSITY = verbosity_level()
+
+
 def log(*args, min_level=0):
-    if verbosity_level() >= min_level:
-        print('DEPY: ', *args, file=sys.stderr)
+    if min_level > _VERBOSITY:
+        return
+
+    print('DEPY: ', *args, file=sys.stderr)
@@ -1,34 +1,88 @@
 import os
 import re
-import json
+import stat
 import sys
 from pathlib import Path
 from subprocess import check_call, check_output, STDOUT, CalledProcessError
-from functools import lru_cache
-from uuid import uuid4
+from functools import cached_property, lru_cache
 
 from .logging import log
 
 
+_Version = None     # Loaded on first use by _get_version_class()
+
+
+def _get_version_class():
+    """
+    Import the version class the first time that it's needed, since most runs never have to compare versions.
+    """
+    global _Version
+
+    if _Version is None:
+        try:
+            from packaging.version import Version
+        except BaseException as e:
+            import warnings
+            warnings.filterwarnings("ignore", category=DeprecationWarning)
+            warnings.filterwarnings("ignore", category=UserWarning)
+            from distutils.version import LooseVersion as Version
+
+        _Version = Version
+
+    return _Version
+
+
+@lru_cache(maxsize=4096)
+def _parse_version(version: str):
+    """
+    The same version strings are parsed again for every spec and every pass while resolving, so the parsed versions are cached.
+    """
+    return _get_version_class()(version)
+
+# The cache files are read and written as bytes so that orjson can be used when it's available
 try:
-    from packaging.version import Version
-except BaseException as e:
-    import warnings
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    warnings.filterwarnings("ignore", category=UserWarning)
-    from distutils.version import LooseVersion as Version
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 
 CACHE_FILE_TIMEOUT_S = 60 * 30
 DEFAULT_URL          = 'https://pypi.org/simple'
 
+_REQUIRES_DIST_RE    = re.compile(r'Requires-Dist:\s*([^\(]+?)(?:\s*\(([^\)]+)\))?\s*(;.+)?\s*$')
+_SPEC_RE             = re.compile(r'^\s*((?:any|[!~=><]+))\s*(.+)?')
+_RELEASE_RE          = re.compile(r'\d+(?:\.\d+)*', re.ASCII)
+
+
+@lru_cache(maxsize=None)
+def _python_hash() -> str:
+    """
+    The cached packages are separated by the interpreter they were installed for, which can't change while running. This is only
+    needed once something has to be resolved or installed, so it isn't computed at startup.
+    """
+    import hashlib
+
+    return hashlib.sha256(os.path.realpath(sys.executable).encode('utf-8')).hexdigest()
+
 
 class PackageStorage():
-    @lru_cache()
-    def get_module_structure(self, location: Path, depth_max: int=None) -> dict:
+    def __init__(self):
+        # The .dist-info directories found at the top of each location while determining its module structure
+        self._dist_info_by_location = {}
+
+
+    @lru_cache(maxsize=None)
+    def get_module_structure(self, location: Path) -> dict:
         """
-        Get the module structure for the path provided. If a maximum depth is provided (>=1) then the
-        structure will only be determined up until that depth.
+        Get the module structure for the path provided.
 
         For a directory structure:
         <location>
@@ -51,111 +105,141 @@ class PackageStorage():
         }
 
         Note that the 'third' subdirectory will not be included because there is nothing loadable under that path.
+
+        The structure is only determined once for each location.
         """
         if not os.path.isdir(location):
             return {}
 
-        structure = {}
-        depth     = 0
-
-        try:
-            location_root = None
-
-            for root, dirnames, filenames in os.walk(location):
-                if not location_root:
-                    location_root = root
+        structure  = {}
+        dist_infos = []
+        self._scan_module_structure(str(location), '', '', structure, dist_infos)
+        self._dist_info_by_location[location] = dist_infos
+        return structure
 
-                depth += 1
 
-                if location_root == root:
-                    relative_root = ''
-                else:
-                    relative_root = root.replace(location_root + os.path.sep, '')
+    def _scan_module_structure(self, directory, relative_root, dotted_root, structure, dist_infos=None):
+        """
+        Add the loadable files and directories under the directory to the structure, recursing into the
+        subdirectories. The relative path and dotted module name of the directory are passed down so that the names
+        don't have to be rebuilt from the full paths. If a list is given for the dist-infos then the paths of the
+        '*-*.dist-info' directories are added to it.
+        """
+        filenames = []
+        dirnames  = []
 
-                for filename in filenames:
-                    self._add_file_to_structure(filename, relative_root, structure)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
 
-                for dirname in dirnames:
-                    if dirname != '__pycache__' and not dirname.endswith('.dist-info'):
-                        if os.path.join(relative_root, dirname).replace(os.path.sep, '.') not in structure:
-                            structure[os.path.join(relative_root, dirname).replace(os.path.sep, '.')] = os.path.join(relative_root, dirname)
+                    if not is_dir:
+                        filenames.append(entry.name)
+                    elif entry.name.endswith('.dist-info'):
+                        if dist_infos is not None and '-' in entry.name and not entry.name.startswith('.'):
+                            dist_infos.append(entry.path)
+                    elif entry.name != '__pycache__':
+                        dirnames.append(entry)
+        except OSError:
+            return
 
-                if depth_max and depth == depth_max:
-                    break
-        except CalledProcessError as exc:
-            log('Error: Unable to get the structure for', location)
-            log(exc.stdout)
-            log(exc.stderr)
+        relative_prefix = f'{relative_root}{os.sep}' if relative_root else ''
+        dotted_prefix   = f'{dotted_root}.' if dotted_root else ''
 
-        return structure
+        for filename in filenames:
+            relative_filename = relative_prefix + filename
 
+            if filename == '__init__.py':
+                structure[dotted_root] = relative_filename
+            elif filename.endswith('.so'):
+                structure[dotted_prefix + filename.split('.')[0]] = relative_filename
 
-    def _add_file_to_structure(self, filename, relative_root, structure):
-        relative_filename = os.path.join(relative_root, filename)
+            if filename.endswith('.py'):
+                structure[dotted_prefix + filename[:-3]] = relative_filename
 
-        if filename == '__init__.py':
-            structure[relative_root.replace(os.path.sep, '.')] = relative_filename
-        elif filename.endswith('.so'):
-            name      = os.path.basename(filename).split('.')[0]
-            parent    = os.path.dirname(relative_filename).replace(os.path.sep, '.')
-            full_name = (parent + '.' if parent else '') + name
-            structure[full_name] = relative_filename
+        for entry in dirnames:
+            if dotted_prefix + entry.name not in structure:
+                structure[dotted_prefix + entry.name] = relative_prefix + entry.name
 
-        if filename.endswith('.py'):
-            structure[relative_filename.replace('.py', '').replace(os.path.sep, '.')] = relative_filename
+        for entry in dirnames:
+            # Symlinked directories are listed but not followed, the same as os.walk
+            if not entry.is_symlink():
+                self._scan_module_structure(entry.path, relative_prefix + entry.name, dotted_prefix + entry.name, structure)
 
 
     def _write_structure(self, location):
-        with open(location / '.structure', 'w') as fh:
-            json.dump(self.get_module_structure(location), fh)
+        with open(location / '.structure', 'wb') as fh:
+            fh.write(json_dumps(self.get_module_structure(location)))
 
 
     def _write_dependencies(self, name, location):
-        import glob
-
-        cmd     = [sys.executable, '-m', 'pip', 'freeze', '--path', location]
-        results = check_output(cmd)
-
-        with open(location / '.packages', 'wt') as fh:
-            fh.write(results.decode('utf-8'))
-
+        """
+        Write the installed packages and the dependencies of the package from the METADATA files of the installed distributions.
+        Only the headers are read, which end at the first empty line, so each file is opened once and the description is skipped.
+        """
         self._write_structure(location)
-        glob_results = glob.glob(os.path.join(location, f'*-*.dist-info'))
+        dist_infos   = self._dist_info_by_location.get(location, [])
         final_dir    = []
+        packages     = []
+        dependencies = []
 
-        for result in glob_results:
+        for result in dist_infos:
             if name.lower().replace("-","_") in result.lower():
                 final_dir.append(result)
 
-        if len(final_dir) == 1:
-            metadata = os.path.join(final_dir[0], 'METADATA')
+        for result in dist_infos:
+            read_dependencies = len(final_dir) == 1 and result == final_dir[0]
+            package_name      = None
+            package_version   = None
 
-            if os.path.isfile(metadata):
-                dependencies = ''
-
-                with open(metadata, 'rt') as fh:
-                    metadata_txt = fh.readlines()
-
-                for line in metadata_txt:
-                    match = re.match(r'Requires-Dist:\s*([^\(]+?)(?:\s*\(([^\)]+)\))?\s*(;.+)?\s*$', line.strip())
-
-                    if match:
-                        dependencies += match.group(1).strip()
-
-                        if match.group(2):
-                            dependencies += match.group(2).strip()
+            try:
+                with open(os.path.join(result, 'METADATA'), 'rt', encoding='utf-8') as fh:
+                    for line in fh:
+                        # The headers end at the first empty line. Folded headers continue on lines starting with whitespace, which
+                        # can be blank once stripped, so those are skipped instead.
+                        if line in ('\n', '\r\n'):
+                            break
+
+                        if line[:1].isspace():
+                            continue
+
+                        line = line.strip()
+
+                        if line.startswith('Name:'):
+                            package_name = line[5:].strip()
+                        elif line.startswith('Version:'):
+                            package_version = line[8:].strip()
+                        elif read_dependencies:
+                            match = _REQUIRES_DIST_RE.match(line)
+
+                            if match:
+                                dependency = match.group(1).strip()
+
+                                if match.group(2):
+                                    dependency += match.group(2).strip()
+
+                                if match.group(3):
+                                    dependency += match.group(3).strip()
+
+                                dependencies.append(dependency)
+                            elif 'Requires-Dist' in line:
+                                print('Unknown dependency line:', line)
+                                exit(1)
+            except OSError:
+                continue
 
-                        if match.group(3):
-                            dependencies += match.group(3).strip()
+            if package_name and package_version:
+                packages.append(f'{package_name}=={package_version}')
 
-                        dependencies += "\n"
-                    elif 'Requires-Dist' in line:
-                        print('Unknown dependency line:', line)
-                        exit(1)
+        with open(location / '.packages', 'wt') as fh:
+            fh.write(''.join(package + '\n' for package in sorted(packages, key=str.lower)))
 
-                if dependencies:
-                    with open(location / '.dependencies', 'wt') as fh:
-                        fh.write(dependencies)
+        if dependencies:
+            with open(location / '.dependencies', 'wt') as fh:
+                fh.write('\n'.join(dependencies) + '\n')
 
 
     def _pip_install(self, name, version, location):
@@ -187,12 +271,13 @@ class PackageStorage():
 
         try:
             self._write_dependencies(name, location)
-            installed_file_name = self._get_installed_cache_file(location)
 
-            try:
-                os.unlink(installed_file_name)
-            except:
-                pass
+            # A new version is available locally, so the installed and resolved versions need to be recomputed
+            for cache_file_name in (self._get_installed_cache_file(location), self._get_resolved_cache_file(location)):
+                try:
+                    os.unlink(cache_file_name)
+                except:
+                    pass
 
             return True
         except BaseException:
@@ -200,49 +285,46 @@ class PackageStorage():
             return False
 
 
-    @lru_cache()
-    def _python_hash(self):
-        import hashlib
+    def _get_index(self, offset=0):
+        if offset < len(self._index_list):
+            return self._index_list[offset]
 
-        sha = hashlib.sha256()
-        executable = os.path.realpath(sys.executable)
-        sha.update(executable.encode('utf-8'))
-        return sha.hexdigest()
+        return None
 
 
-    def _get_index(self, offset=0):
-        if offset == 0:
-            return DEFAULT_URL
-
-        other_indexes = os.environ.get('DEPY_INDEXES', '').split(';')
+    @cached_property
+    def _index_list(self):
+        """
+        The default index followed by the ones in DEPY_INDEXES, with their credentials added. These can't change while running, so
+        the token files are only read once.
+        """
+        return [DEFAULT_URL] + [self._credentialize(index.strip()) for index in os.environ.get('DEPY_INDEXES', '').split(';')]
 
-        if offset - 1 < len(other_indexes):
-            index = other_indexes[offset - 1].strip()
-            checked_indexes = set()
 
-            for name in index.split('/'):
-                if name in checked_indexes:
-                    continue
+    def _credentialize(self, index):
+        checked_indexes = set()
 
-                checked_indexes.add(name)
-                possible_token_file = Path.home() / '.ssh' / ('pypy_' + name.lower())
+        for name in index.split('/'):
+            if name in checked_indexes:
+                continue
 
-                if name and possible_token_file.exists():
-                    with open(possible_token_file, 'r') as fh:
-                        token = fh.read().strip()
+            checked_indexes.add(name)
+            possible_token_file = Path.home() / '.ssh' / ('pypy_' + name.lower())
 
-                    username = os.environ.get('DEPY_USERNAME', 'pat')
+            if name and possible_token_file.exists():
+                with open(possible_token_file, 'r') as fh:
+                    token = fh.read().strip()
 
-                    if index.startswith('https://'):
-                        index = index.replace('https://', 'https://' + username + ':' + token + '@')
-                    else:
-                        index = 'username:' + token + '@' + index
+                username = os.environ.get('DEPY_USERNAME', 'pat')
 
-                    break
+                if index.startswith('https://'):
+                    index = index.replace('https://', 'https://' + username + ':' + token + '@')
+                else:
+                    index = 'username:' + token + '@' + index
 
-            return index
+                break
 
-        return None
+        return index
 
 
     def _install(self, name, version, location):
@@ -254,23 +336,74 @@ class PackageStorage():
         return location.parent.parent / '.installed'
 
 
-    def _get_installed_versions(self, path_root):
+    def _read_if_fresh(self, path: Path):
+        """
+        Read a cache file if it has been modified within the cache timeout. The file is opened once and its mtime is taken from
+        the open file, instead of a separate stat before opening it. Returns the contents and the mtime, or (None, None) when the
+        file is stale. Errors opening the file are raised.
+        """
         import time
+
+        with open(path, 'rb') as fh:
+            mtime = os.fstat(fh.fileno()).st_mtime
+
+            if mtime > time.time() - (CACHE_FILE_TIMEOUT_S):
+                return fh.read(), mtime
+
+        return None, None
+
+
+    def _get_resolved_cache_file(self, location: Path) -> Path:
+        return location.parent.parent / '.resolved'
+
+
+    def _get_resolved_versions(self, path_root):
+        """
+        Load the versions that the requirement specs were previously resolved to. The mtime of the loaded file is
+        returned as well so that it can be preserved when new resolutions are written back.
+        """
+        resolved_file_name = path_root / '.resolved'
+
+        try:
+            contents, mtime = self._read_if_fresh(resolved_file_name)
+
+            if contents is not None:
+                log('Loading the resolved version cache file', resolved_file_name, min_level=2)
+                return json_loads(contents), mtime
+        except:
+            pass
+
+        return {}, None
+
+
+    def _write_resolved_version(self, path_root, spec, version):
+        resolved_file_name = path_root / '.resolved'
+        resolved, mtime    = self._get_resolved_versions(path_root)
+        resolved.setdefault(_python_hash(), {})[spec] = version
+
+        try:
+            log('Writing the resolved version cache file', resolved_file_name, min_level=3)
+
+            # Keep the original timestamp so that adding resolutions doesn't extend the lifetime of the older ones
+            _atomic_write_json(resolved_file_name, resolved, mtime)
+        except BaseException as e:
+            log('Exception while writing to the resolved version cache', e, min_level=1)
+
+
+    def _get_installed_versions(self, path_root):
         import glob
 
         installed_file_name = path_root / '.installed'
-        pyhash              = self._python_hash()
 
         try:
-            stats = os.stat(installed_file_name)
+            contents, _ = self._read_if_fresh(installed_file_name)
 
-            if stats.st_mtime > time.time() - (CACHE_FILE_TIMEOUT_S):
-                with open(installed_file_name, 'r') as fh:
-                    log('Loading the install file at', installed_file_name, min_level=2)
-                    loaded = json.load(fh)
+            if contents is not None:
+                log('Loading the install file at', installed_file_name, min_level=2)
+                loaded = json_loads(contents)
 
-                    if pyhash in loaded:
-                        return loaded[pyhash]
+                if _python_hash() in loaded:
+                    return loaded[_python_hash()]
         except:
             pass
 
@@ -289,86 +422,166 @@ class PackageStorage():
             versions[python_version].append(version_number)
 
         try:
-            tmp_name = str(installed_file_name) + '.' + uuid4().hex
-
-            with open(tmp_name, 'w') as fh:
-                log('Writing the installation cache file', tmp_name, min_level=3)
-                json.dump(versions, fh)
-
-            os.chmod(tmp_name, 777)
-            os.replace(tmp_name, installed_file_name)
+            log('Writing the installation cache file', installed_file_name, min_level=3)
+            _atomic_write_json(installed_file_name, versions)
         except BaseException as e:
             log('Exception while writing to the installed version cache', e, min_level=1)
 
-            try:
-                os.unlink(tmp_name)
-            except:
-                pass
-
-        return versions.get(pyhash, [])
+        return versions.get(_python_hash(), [])
 
 
     def get_available_versions(self, name: str, path_root: Path):
-        import time
+        available_file_name = path_root / '.available'
 
         try:
-            available_file_name = path_root / '.available'
-            stats               = os.stat(available_file_name)
+            contents, _ = self._read_if_fresh(available_file_name)
 
-            if stats.st_mtime > time.time() - (CACHE_FILE_TIMEOUT_S):
-                with open(available_file_name, 'r') as fh:
-                    log('Loading the available version cache file', available_file_name, min_level=2)
-                    return json.load(fh)
+            if contents is not None:
+                log('Loading the available version cache file', available_file_name, min_level=2)
+                return json_loads(contents)
         except:
             pass
 
+        available = self._get_api_versions(name)
+
+        if not available:
+            index_offset = 0
+            index        = self._get_index()
+            result       = None
+
+            while index and not result:
+                cmd = [sys.executable, '-m', 'pip', 'index', 'versions', '--disable-pip-version-check', '--pre', '-i', index, name]
+
+                try:
+                    result = check_output(cmd, stderr=STDOUT).decode('utf-8').strip()
+                except CalledProcessError:
+                    index_offset += 1
+                    index = self._get_index(index_offset)
+
+            if not result:
+                log('Error: Could not get the available versions for', name)
+                return []
+
+            for line in result.splitlines(keepends=False):
+                log('Processing version line:', line, min_level=3)
+
+                if line.startswith('Available versions:'):
+                    available = line.replace('Available versions: ', '').split(',')
+                    break
+
+            if not available:
+                return []
+
+        try:
+            log('Writing available version cache', available_file_name, min_level=3)
+            _atomic_write_json(available_file_name, available)
+        except BaseException as e:
+            log('Exception while writing to the available version cache', e, min_level=1)
+
+        return available
+
+
+    def _get_api_versions(self, name: str):
+        """
+        Get the available versions from the JSON API of the indexes, which only takes a single request instead of starting
+        pip. Releases without any files, or where every file has been yanked, are skipped the same as pip would. If the files
+        can't be checked against the running interpreter then they're all considered installable, and if none of the indexes
+        respond then None is returned so that pip is used instead.
+        """
+        import base64
+        import urllib.request
+        from urllib.parse import urlsplit, urlunsplit, quote
+
+        class CredentialRedirectHandler(urllib.request.HTTPRedirectHandler):
+            """
+            urllib copies all of the headers onto redirects, so drop the credentials when being sent to a different host or scheme
+            """
+            def redirect_request(self, req, fp, code, msg, headers, newurl):
+                redirected = super().redirect_request(req, fp, code, msg, headers, newurl)
+
+                if redirected is not None:
+                    original, target = urlsplit(req.full_url), urlsplit(redirected.full_url)
+
+                    if (original.scheme, original.netloc) != (target.scheme, target.netloc):
+                        redirected.remove_header('Authorization')
+
+                return redirected
+
+        opener = urllib.request.build_opener(CredentialRedirectHandler)
+
+        try:
+            from packaging.specifiers import SpecifierSet
+            from packaging.tags import sys_tags
+            from packaging.utils import parse_wheel_filename
+
+            python_version = '.'.join(map(str, sys.version_info[:3]))
+            supported_tags = set(sys_tags())
+        except:
+            supported_tags = None
+
         index_offset = 0
         index        = self._get_index()
-        result       = None
-
-        while index and not result:
-            cmd = [sys.executable, '-m', 'pip', 'index', 'versions', '--disable-pip-version-check', '--pre', '-i', index, name]
 
+        while index:
             try:
-                result = check_output(cmd, stderr=STDOUT).decode('utf-8').strip()
-            except CalledProcessError:
-                index_offset += 1
-                index = self._get_index(index_offset)
+                url     = urlsplit(index)
+                headers = {'Accept': 'application/json'}
 
-        if not result:
-            log('Error: Could not get the available versions for', name)
-            return []
+                # Credentials are sent as a header instead of being left in the URL
+                if url.username or url.password:
+                    credentials              = f'{url.username or ""}:{url.password or ""}'.encode('utf-8')
+                    headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+                    url                      = url._replace(netloc=url.netloc.rsplit('@', 1)[1])
 
-        for line in result.splitlines(keepends=False):
-            log('Processing version line:', line, min_level=3)
+                root = url.path.rstrip('/')
 
-            if line.startswith('Available versions:'):
-                available = line.replace('Available versions: ', '').split(',')
+                if root.endswith('/simple'):
+                    root = root[:-len('/simple')]
 
-                try:
-                    tmp_name = str(available_file_name) + '.' + uuid4().hex
+                api_url = urlunsplit((url.scheme, url.netloc, f'{root}/pypi/{quote(name)}/json', '', ''))
+                log('Requesting the available versions from', api_url, min_level=2)
 
-                    with open(tmp_name, 'w') as fh:
-                        log('Writing available version cache', tmp_name, min_level=3)
-                        json.dump(available, fh)
+                with opener.open(urllib.request.Request(api_url, headers=headers), timeout=10) as response:
+                    releases = json_loads(response.read())['releases']
 
-                    os.chmod(tmp_name, 777)
-                    os.replace(tmp_name, available_file_name)
-                except BaseException as e:
-                    log('Exception while writing to the available version cache', e, min_level=1)
+                available = []
 
-                    try:
-                        os.unlink(tmp_name)
-                    except:
-                        pass
+                for version, files in releases.items():
+                    installable = False
+
+                    for file in files:
+                        if file.get('yanked'):
+                            continue
+
+                        if supported_tags is not None:
+                            try:
+                                if file.get('requires_python') and python_version not in SpecifierSet(file['requires_python']):
+                                    continue
 
-                return available
+                                if file['filename'].endswith('.whl') and supported_tags.isdisjoint(parse_wheel_filename(file['filename'])[3]):
+                                    continue
+                            except:
+                                pass
 
-        return []
+                        installable = True
+                        break
+
+                    if installable:
+                        available.append(version)
+
+                if available:
+                    return available
+            except BaseException as e:
+                log('Unable to get the available versions for', name, 'from the index API -', e, min_level=2)
+
+            index_offset += 1
+            index = self._get_index(index_offset)
+
+        return None
 
 
     def parse_requirement_spec(self, version):
-        match = re.fullmatch(r'^\s*((?:any|[!~=><]+))\s*(.+)?', version)
+        match = _SPEC_RE.fullmatch(version)
 
         if match:
             op  = match.group(1)
@@ -386,31 +599,7 @@ class PackageStorage():
 
 
     def compare_versions(self, version1: str, operation: str, version2: str) -> bool:
-        match = False
-
-        if operation == '==':
-            match = version1 == version2
-        elif operation == '~=':
-            if version1 >= version2:
-                if len(version2.release) > 2:
-                    match = version2.major == version1.major and version2.minor == version1.minor
-                elif len(version2.release) > 1:
-                    match = version2.major == version1.major
-        elif operation == '<':
-            match = version1 < version2
-        elif operation == '>':
-            match = version1 > version2
-        elif operation == '<=':
-            match = version1 <= version2
-        elif operation == '>=':
-            match = version1 >= version2
-        elif operation == '!=':
-            match = version1 != version2
-        else:
-            log('Error: Unknown Requirements Operation -', operation)
-            exit(1)
-
-        return match
+        return _compare_versions(str(version1), operation, str(version2))
 
 
     def _match_py_requirements(self, requirements, versions):
@@ -419,26 +608,12 @@ class PackageStorage():
 
         for version in versions:
             try:
-                ver = Version(version)
+                _parse_version(version)
             except:
                 continue
 
-            for req in requirement_specs:
-                match = False
-
-                if req['op'] == 'any':
-                    match = True
-                else:
-                    req_ver = Version(req['ver'])
-                    match   = self.compare_versions(ver, req['op'], req_ver)
-
-                if match:
-                    matching_reqs.add(version)
-                else:
-                    if version in matching_reqs:
-                        matching_reqs.remove(version)
-
-                    break
+            if all(req['op'] == 'any' or self.compare_versions(version, req['op'], req['ver']) for req in requirement_specs):
+                matching_reqs.add(version)
 
         return list(matching_reqs)
 
@@ -449,7 +624,7 @@ class PackageStorage():
         if not matching_versions:
             return None
 
-        return sorted(matching_versions, key=Version)[-1]
+        return sorted(matching_versions, key=_parse_version)[-1]
 
 
     def _quick_resolve_version(self, version):
@@ -457,6 +632,15 @@ class PackageStorage():
         If we only have a single requirement and it's just '==', then we don't have to perform
         additional processing, we know that's the desired version
         """
+        # Most specs are pinned versions, which only need to be sliced. The character after '==' is checked so that other operators
+        # starting with it, like '===', are still parsed
+        if version.startswith('==') and ',' not in version and '*' not in version and version[2:3] not in '!~=><':
+            pinned = version[2:].strip()
+
+            if pinned:
+                log('Quickly resolved', version, 'to', pinned, min_level=2)
+                return pinned
+
         if ',' not in version:
             specs = self.parse_requirement_spec(version)
 
@@ -471,6 +655,13 @@ class PackageStorage():
         version = self._quick_resolve_version(spec)
 
         if not version:
+            resolved, _ = self._get_resolved_versions(path_root)
+            version     = resolved.get(_python_hash(), {}).get(spec)
+
+            if version:
+                log('Resolved version loaded from the cache', name, spec, ' - ', version, min_level=2)
+                return version
+
             version = self._get_proper_version(spec, self._get_installed_versions(path_root))
 
             if not version:
@@ -480,6 +671,8 @@ class PackageStorage():
                     log('No matching versions found for', name, spec, min_level=2)
                     return None
 
+            self._write_resolved_version(path_root, spec, version.strip())
+
         log('Resolved version', name, spec, ' - ', version, min_level=2)
         return version.strip()
 
@@ -492,7 +685,7 @@ class PackageStorage():
         if not cache_version:
             return None
 
-        cache_location = path_root / cache_version / self._python_hash()
+        cache_location = path_root / cache_version / _python_hash()
 
         if self.is_cached(cache_location):
             return cache_location
@@ -500,7 +693,9 @@ class PackageStorage():
         if cache_location.exists():
             remove_tree(cache_location)
 
-        temp_location = path_root / cache_version / ('.' + self._python_hash() + '_' + uuid4().hex)
+        from uuid import uuid4
+
+        temp_location = path_root / cache_version / ('.' + _python_hash() + '_' + uuid4().hex)
         log('Temporary cache location:', temp_location, min_level=2)
         os.umask(0)
 
@@ -509,9 +704,8 @@ class PackageStorage():
 
             try:
                 Path.touch(temp_location / '.cached')
-                chmod(temp_location, 0o555)
                 # Make the root of the cache writable so that we can create and maintain the available versions
-                os.chmod(temp_location, 0o777)
+                chmod(temp_location, 0o555, root_mode=0o777)
                 os.rename(temp_location, cache_location)
             except:
                 pass
@@ -539,20 +733,21 @@ class PackageStorage():
         if cache_location.exists():
             remove_tree(cache_location)
 
+        from uuid import uuid4
+
         basename = '.' + str(os.path.basename(cache_location)) + '_' + uuid4().hex
         temp_location = cache_location.parent / basename
         os.makedirs(temp_location, mode=0o777, exist_ok=True)
         log('Temporary requirements cache location:', temp_location, min_level=2)
         os.umask(0)
 
-        with open(temp_location / 'resolution', 'w') as fh:
-            json.dump(dependencies, fh)
+        with open(temp_location / 'resolution', 'wb') as fh:
+            fh.write(json_dumps(dependencies))
 
         try:
             Path.touch(temp_location / '.cached')
-            chmod(temp_location, 0o555)
             # Make the root of the cache writable so that we can create rename it
-            os.chmod(temp_location, 0o777)
+            chmod(temp_location, 0o555, root_mode=0o777)
             os.rename(temp_location, cache_location)
             os.chmod(cache_location, 0o555)
         except:
@@ -571,11 +766,115 @@ class PackageStorage():
 
 
 
+@lru_cache(maxsize=4096)
+def _compare_versions(version1: str, operation: str, version2: str) -> bool:
+    """
+    Compare two versions with the provided operation. This is keyed on the version strings, since the same comparisons are repeated
+    for every candidate version of a library while resolving.
+    """
+    release1 = _parse_release(version1)
+    release2 = _parse_release(version2)
+    match    = False
+
+    if release1 is not None and release2 is not None:
+        # Plain dotted versions order the same as their release numbers once the trailing zeros are dropped
+        version1 = _strip_release(release1)
+        version2 = _strip_release(release2)
+    else:
+        version1 = _parse_version(version1)
+        version2 = _parse_version(version2)
+
+        if operation == '~=':
+            release1 = version1.release
+            release2 = version2.release
+
+    if operation == '==':
+        match = version1 == version2
+    elif operation == '~=':
+        if version1 >= version2:
+            if len(release2) > 2:
+                match = release2[0] == release1[0] and release2[1] == (release1[1] if len(release1) > 1 else 0)
+            elif len(release2) > 1:
+                match = release2[0] == release1[0]
+    elif operation == '<':
+        match = version1 < version2
+    elif operation == '>':
+        match = version1 > version2
+    elif operation == '<=':
+        match = version1 <= version2
+    elif operation == '>=':
+        match = version1 >= version2
+    elif operation == '!=':
+        match = version1 != version2
+    else:
+        log('Error: Unknown Requirements Operation -', operation)
+        exit(1)
+
+    return match
+
+
+def _parse_release(version: str) -> tuple:
+    """
+    Get the release numbers of a version that is only made up of dotted numbers, most versions look like this and
+    can be compared without constructing a Version. Anything else (pre, post, dev, local, epochs) returns None.
+    """
+    if _RELEASE_RE.fullmatch(version):
+        return tuple(map(int, version.split('.')))
+
+    return None
+
+
+def _strip_release(release: tuple) -> tuple:
+    end = len(release)
+
+    while end and release[end - 1] == 0:
+        end -= 1
+
+    return release[:end]
+
+
+def _atomic_write_json(path: Path, obj, mtime: float=None):
+    """
+    Write the object as JSON to a temporary file next to the path, and then move it into place so that readers never see a partial
+    file. The file is created readable and writable by everyone (less the umask) instead of changing its mode afterwards. If an
+    mtime is given then the file keeps that modification time.
+    """
+    from uuid import uuid4
+
+    tmp_name = f'{path}.{uuid4().hex}'
+
+    try:
+        with open(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), 'wb') as fh:
+            fh.write(json_dumps(obj))
+
+        if mtime is not None:
+            os.utime(tmp_name, (mtime, mtime))
+
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except:
+            pass
+
+        raise
+
+
 def remove_tree(cache_location):
     try:
         import shutil
 
         log('Removing the existing cache location', min_level=1)
+
+        # Only the directories need to be writable to remove the files in them, and the caches only restrict the permissions of the
+        # root and the files. Everything is made writable if that isn't enough.
+        try:
+            os.chmod(cache_location, 0o777)
+            shutil.rmtree(cache_location)
+            return
+        except:
+            pass
+
         try:
             chmod(cache_location, 0o777)
         except:
@@ -586,11 +885,40 @@ def remove_tree(cache_location):
         log('Error: Unable to remove the existing cache location', cache_location)
 
 
-def chmod(path: Path, mode: int):
-    for root, dirs, files in os.walk(path):
-        # set perms on files
-        for file in files:
-            os.chmod(os.path.join(root, file), mode)
+def chmod(path: Path, mode: int, root_mode: int=None):
+    """
+    Set the mode of all of the files under the path, and then the path itself. The root can be given a different mode, which
+    saves having to change it again afterwards.
+    """
+    _chmod_files(str(path), mode)
+    os.chmod(path, mode if root_mode is None else root_mode)
+
+
+def _chmod_files(directory: str, mode: int):
+    """
+    Set the mode of the files in the directory and its subdirectories. The modes are known from the directory listing, so only
+    the files that don't already have the mode are changed. Symlinks are skipped, changing them would change their targets.
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        directory_fd = os.open(directory, os.O_RDONLY) if os.chmod in os.supports_dir_fd else None
 
-    os.chmod(path, mode)
-    os.getcwd
+        try:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    _chmod_files(entry.path, mode)
+                elif stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode) != mode:
+                    if directory_fd is not None:
+                        os.chmod(entry.name, mode, dir_fd=directory_fd)
+                    else:
+                        os.chmod(entry.path, mode)
+        finally:
+            if directory_fd is not None:
+                os.close(directory_fd)
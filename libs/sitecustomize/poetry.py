@@ -1,4 +1,6 @@
 class PoetryRequirement():
+    __slots__ = ('package', 'version', 'extras')
+
     def __init__(self, package, version, marker=None):
         self.package = package
         self.version = version
@@ -33,14 +35,19 @@ class PoetryResults():
 class PoetryFile():
     @staticmethod
     def from_lock_file(input_file):
-        import toml
-
-        with open(input_file, 'r') as fh:
-            loaded = toml.load(fh)
-
-        packages = []
-
-        for package in loaded.get('package', {}):
-            packages.append(PoetryRequirement(package['name'], package['version']))
-
-        return PoetryResults(packages)
+        # Prefer the standard library parser, and then tomli which is what it's based on, over the pure python toml package
+        try:
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+
+            with open(input_file, 'rb') as fh:
+                loaded = tomllib.load(fh)
+        except ImportError:
+            import toml
+
+            with open(input_file, 'r') as fh:
+                loaded = toml.load(fh)
+
+        return PoetryResults([PoetryRequirement(package['name'], package['version']) for package in loaded.get('package', [])])
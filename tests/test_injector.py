@@ -0,0 +1,277 @@
+import os
+import sys
+import subprocess
+import time
+from pathlib import Path
+
+
+TEST_PATH = Path(os.path.realpath(__file__)).parent
+LIBS_PATH = TEST_PATH.parent / 'libs'
+sys.path.insert(0, str(TEST_PATH.parent))
+
+
+
+def run_with_injector(tmp_path: Path, args: list, python_paths: list = ()) -> str:
+    """
+    Run python with the injector loaded the same way that bin/depy does, with a requirements file that doesn't need anything
+    installed. Any provided python paths are added to PYTHONPATH after the injector.
+    """
+    requirements = tmp_path / 'requirements.txt'
+    requirements.touch()
+
+    python_path = os.pathsep.join([str(LIBS_PATH)] + [str(path) for path in python_paths])
+    env         = dict(os.environ, DEPY_REQS=str(requirements), DEPY_CACHE_PATH=str(tmp_path / 'cache'), PYTHONPATH=python_path)
+    env.pop('DEPY_BYPASS_CACHE', None)
+    result = subprocess.run([sys.executable] + args, env=env, cwd=tmp_path, capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def test_script_directory_shadows_modules(tmp_path):
+    project = tmp_path / 'project'
+    project.mkdir()
+
+    with open(project / 'queue.py', 'w') as fh:
+        fh.write('')
+
+    with open(project / 'main.py', 'w') as fh:
+        fh.write('import queue\nprint(queue.__file__)\n')
+
+    assert run_with_injector(tmp_path, [str(project / 'main.py')]) == str(project / 'queue.py')
+
+
+def test_inserted_sys_path_after_lookup(tmp_path):
+    vendored = tmp_path / 'vendored'
+    vendored.mkdir()
+
+    with open(vendored / 'colorsys.py', 'w') as fh:
+        fh.write('')
+
+    script = ('import sys, importlib.util\n'
+              'importlib.util.find_spec("colorsys")\n'
+              f'sys.path.insert(0, {str(vendored)!r})\n'
+              'print(importlib.util.find_spec("colorsys").origin)\n')
+
+    assert run_with_injector(tmp_path, ['-c', script]) == str(vendored / 'colorsys.py')
+
+
+def test_earlier_python_path_shadows_later(tmp_path):
+    paths = [tmp_path / 'first', tmp_path / 'second']
+
+    for path in paths:
+        path.mkdir()
+
+        with open(path / 'shadowed.py', 'w') as fh:
+            fh.write('')
+
+    # Looking up another module first builds the complete requirements, which the second lookup is then served from
+    script = 'import colorsys, shadowed\nprint(shadowed.__file__)\n'
+
+    assert run_with_injector(tmp_path, ['-c', script], paths) == str(paths[0] / 'shadowed.py')
+
+
+def make_package(location, name, *modules):
+    """
+    Create a package with an __init__.py and the provided submodules, returning its directory.
+    """
+    package = location / name
+    package.mkdir(parents=True)
+    (package / '__init__.py').touch()
+
+    for module in modules:
+        (package / f'{module}.py').touch()
+
+    return package
+
+
+def test_forced_package_submodules(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    resolved = make_package(tmp_path / 'resolved', 'pkg', 'sub')
+    forced   = make_package(tmp_path / 'forced', 'pkg', 'sub')
+
+    # The resolved requirements hold every level of the package, but the forced copy has to be used for all of them
+    monkeypatch.setattr(injector.DepyInjectorFinder, '_load_requirements',
+                        lambda self: {'pkg': str(resolved / '__init__.py'), 'pkg.sub': str(resolved / 'sub.py')})
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    monkeypatch.setenv('DEPY_FORCEDLIBS', str(tmp_path / 'forced'))
+    monkeypatch.setenv('DEPY_ADD_PP', '0')
+    finder = injector.DepyInjectorFinder('requirements.txt')
+
+    assert finder.find_spec('pkg', None).origin == str(forced / '__init__.py')
+    assert finder.find_spec('pkg.sub', [str(forced)]).origin == str(forced / 'sub.py')
+
+
+def test_inserted_sys_path_package_submodules(tmp_path):
+    paths = [tmp_path / 'inserted', tmp_path / 'existing']
+
+    for path in paths:
+        make_package(path, 'pkg', 'sub')
+
+    script = ('import sys, pkg.sub\n'
+              f'sys.path.insert(0, {str(paths[0])!r})\n'
+              'del sys.modules["pkg"], sys.modules["pkg.sub"]\n'
+              'import pkg.sub\n'
+              'print(pkg.__file__, pkg.sub.__file__)\n')
+
+    assert run_with_injector(tmp_path, ['-c', script], paths[1:]) == f'{paths[0] / "pkg" / "__init__.py"} {paths[0] / "pkg" / "sub.py"}'
+
+
+def test_replaced_sys_path_entry(tmp_path):
+    paths = [tmp_path / 'replacement', tmp_path / 'replaced']
+
+    for path in paths:
+        (path / 'pkg').mkdir(parents=True)
+        (path / 'pkg' / '__init__.py').touch()
+
+    # Replacing an entry in place keeps the size of sys.path the same
+    script = ('import sys, colorsys\n'
+              f'sys.path[sys.path.index({str(paths[1])!r})] = {str(paths[0])!r}\n'
+              'import pkg\n'
+              'print(pkg.__file__)\n')
+
+    assert run_with_injector(tmp_path, ['-c', script], paths[1:]) == str(paths[0] / 'pkg' / '__init__.py')
+
+
+def make_old(*paths):
+    """
+    Move the modification times of the paths back far enough that their index entries can be trusted.
+    """
+    for path in paths:
+        os.utime(path, (time.time() - 60, time.time() - 60))
+
+
+def test_directory_index_invalidation(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    monkeypatch.setattr(injector, 'STORAGE_PATH_INDEX', tmp_path / 'index')
+    finder   = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    location = tmp_path / 'location'
+    (location / 'pkg').mkdir(parents=True)
+    (location / 'namespace').mkdir()
+    (location / 'pkg' / '__init__.py').touch()
+    (location / 'mod.py').touch()
+    make_old(location, location / 'pkg', location / 'namespace')
+
+    assert finder._get_directory_structure(location, use_index=True) == {'mod'      : str(location / 'mod.py'),
+                                                                         'pkg'      : str(location / 'pkg' / '__init__.py'),
+                                                                         'namespace': str(location / 'namespace')}
+    assert len(os.listdir(tmp_path / 'index')) == 1
+
+    # Packages can become namespaces and the other way around, and both have to be picked up from the index
+    os.unlink(location / 'pkg' / '__init__.py')
+    (location / 'namespace' / '__init__.py').touch()
+
+    assert finder._get_directory_structure(location, use_index=True) == {'mod'      : str(location / 'mod.py'),
+                                                                         'pkg'      : str(location / 'pkg'),
+                                                                         'namespace': str(location / 'namespace' / '__init__.py')}
+
+
+def test_directory_index_is_bounded(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    monkeypatch.setattr(injector, 'STORAGE_PATH_INDEX', tmp_path / 'index')
+    monkeypatch.setattr(injector, 'STORAGE_INDEX_MAX_FILES', 2)
+    finder = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+
+    for number in range(5):
+        location = tmp_path / f'location{number}'
+        location.mkdir()
+        make_old(location)
+        finder._get_directory_structure(location, use_index=True)
+
+    assert len(os.listdir(tmp_path / 'index')) == 2
+
+
+def test_directory_index_recent_modifications(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    monkeypatch.setattr(injector, 'STORAGE_PATH_INDEX', tmp_path / 'index')
+    finder   = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    location = tmp_path / 'location'
+    location.mkdir()
+    mtime    = os.stat(location).st_mtime_ns
+
+    assert finder._get_directory_structure(location, use_index=True) == {}
+
+    # Filesystems with coarse timestamps can modify a directory without changing its modification time, so a directory that was
+    # modified around the time that it was scanned can't be indexed
+    (location / 'mod.py').touch()
+    os.utime(location, ns=(mtime, mtime))
+
+    assert finder._get_directory_structure(location, use_index=True) == {'mod': str(location / 'mod.py')}
+
+
+def test_ignored_sys_paths(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    finder = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    finder.sys_path_marker = str(tmp_path / 'marker')
+    (tmp_path / 'marker').mkdir()
+    (tmp_path / 'directory').mkdir()
+    (tmp_path / 'file.zip').touch()
+
+    paths = [str(tmp_path / name) for name in ('marker', 'directory', 'file.zip', 'missing')]
+    monkeypatch.setattr(sys, 'path', paths + [str(tmp_path / 'directory')])
+
+    assert finder._setup_ignored_sys_paths() == {paths[0], paths[2], paths[3]}
+
+
+def test_namespace_after_complete_requirements_change():
+    from libs.sitecustomize import injector
+
+    finder = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    finder.complete_reqs         = {'other': '/location/other.py'}
+    finder._complete_ranks       = {}
+    finder._sorted_complete_keys = None
+
+    finder._find_appropriate_dir('pkg')
+    assert 'pkg' not in finder.complete_reqs
+
+    # Replacing one module with another keeps the size of the complete requirements the same, and the new one has to be searched
+    finder.complete_reqs = {}
+    finder._update_requirements({'pkg.mod': '/location/pkg/mod.py'}, 0)
+    finder._find_appropriate_dir('pkg')
+
+    assert finder.complete_reqs['pkg'] is None
+
+
+def test_post_process_requirements():
+    from libs.sitecustomize import injector
+
+    finder         = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    finder.storage = injector.PackageStorage()
+    requirements   = [{'lib': 'Flask', 'spec': '==1.1.4', 'version': '1.1.4'}, {'lib': 'Werkzeug', 'spec': '==2.2.0', 'version': '2.2.0'}]
+
+    # The modifications are matched regardless of the case of the library names
+    assert finder._post_process_requirements(requirements)
+    assert requirements[1] == {'lib': 'Werkzeug', 'spec': '==2.0.3', 'version': '2.0.3'}
+    assert not finder._post_process_requirements(requirements)
+
+
+def test_post_processed_requirements_refresh(tmp_path, monkeypatch):
+    from libs.sitecustomize import injector
+
+    def cache(root, name, spec):
+        location = tmp_path / 'packages' / name / spec[2:] / 'hash'
+        location.mkdir(parents=True, exist_ok=True)
+
+        with open(location / '.structure', 'w') as fh:
+            fh.write(f'{{"{name.lower()}": "{name.lower()}/__init__.py"}}')
+
+        return str(location)
+
+    def load_requirements():
+        raise AssertionError('The requirements should not be loaded again')
+
+    # Reading the cached requirements back is skipped with DEPY_BYPASS_CACHE, so the refresh can't rely on it
+    monkeypatch.setattr(injector, 'STORAGE_PATH_REQS', tmp_path / 'requirements')
+    monkeypatch.setenv('DEPY_BYPASS_CACHE', '1')
+    finder                    = injector.DepyInjectorFinder.__new__(injector.DepyInjectorFinder)
+    finder.storage            = injector.PackageStorage()
+    finder.storage.cache      = cache
+    finder.lib_metadata       = {}
+    finder._load_requirements = load_requirements
+    locations                 = {'Flask': cache(None, 'Flask', '==1.1.4'), 'Werkzeug': cache(None, 'Werkzeug', '==2.2.0')}
+
+    assert finder._get_module_names(locations, 'hash') == {'flask'   : cache(None, 'Flask', '==1.1.4') + '/flask/__init__.py',
+                                                           'werkzeug': cache(None, 'Werkzeug', '==2.0.3') + '/werkzeug/__init__.py'}